@@ -0,0 +1,55 @@
+# Measures the import time of the scripts: the cold start of the CLI bundler (a fresh interpreter importing
+# lr2_importer) and the re-run of main.py in Blender (lr2_reload.reload_changed with unchanged sources).
+#
+#   py bench_import.py [runs]
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("PIL", "numpy", "bpy")
+
+_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def bench_cold_start(runs: int):
+    code = (
+        "import sys, time\n"
+        "t = time.perf_counter()\n"
+        "import lr2_importer\n"
+        "t = time.perf_counter() - t\n"
+        "print(t, ','.join(m for m in %r if m in sys.modules))\n" % (HEAVY_MODULES,)
+    )
+
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=_dir, capture_output=True, text=True, check=True).stdout.split()
+        timings.append(float(out[0]))
+        if len(out) > 1:
+            raise Exception("Heavy modules imported by lr2_importer: %s" % out[1])
+    return timings
+
+
+def bench_rerun(runs: int):
+    sys.path.insert(0, _dir)
+    import lr2_reload
+    import lr2_importer
+    lr2_reload.stamp()
+
+    timings = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        reloaded = lr2_reload.reload_changed()
+        timings.append(time.perf_counter() - t)
+        if reloaded:
+            raise Exception("Unchanged modules reloaded: %s" % reloaded)
+    return timings
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    for name, timings in (("Cold start (import lr2_importer)", bench_cold_start(runs)), ("Re-run (reload_changed)", bench_rerun(runs))):
+        print("%s: median %.2f ms, min %.2f ms (%d runs)" % (name, statistics.median(timings) * 1000, min(timings) * 1000, runs))
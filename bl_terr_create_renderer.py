@@ -5,7 +5,8 @@ def create_renderer(
         tileset_png: str,
         num_tiles: int,
         layers_map_png: str,
-        alpha_map_png: str
+        alpha_map_png: str,
+        object_tile_uv=None
 ):
     """
     Creates the Material's NodeTree used to render the terrain.
@@ -14,61 +15,87 @@ def create_renderer(
     :param num_tiles:      The number of tiles contained in the tileset (including the NULL one).
     :param layers_map_png: The path to the generated layers map.
     :param alpha_map_png:  The path to the generated alpha map.
+    :param object_tile_uv: If set, the (scale, span) used to compute the tiles UV out of the object coordinates,
+                           for meshes without UV map (see bl_terr_make_mesh.tile_uv_params).
     """
 
     tileset_img = bpy.data.images.load(tileset_png)
     tileset_img.colorspace_settings.name = "sRGB"
 
+    # The maps pack the 4th layer in the alpha channel: it must not be premultiplied into the other layers.
     layers_map_img = bpy.data.images.load(layers_map_png)
     layers_map_img.colorspace_settings.name = "Raw"
+    layers_map_img.alpha_mode = "CHANNEL_PACKED"
 
     alpha_map_img = bpy.data.images.load(alpha_map_png)
     alpha_map_img.colorspace_settings.name = "Raw"
+    alpha_map_img.alpha_mode = "CHANNEL_PACKED"
 
     mat = bpy.context.object.active_material
     mat.use_nodes = True  # Important!
 
-    # ========================================================================
-    # TileUV
-    # ========================================================================
-
-    TileUV = bpy.data.node_groups.new("TileUV", "ShaderNodeTree")
-
-    # UVMap
-    # TODO UVs can be directly retrived from terrain vertices.
-    uv_map = TileUV.nodes.new("ShaderNodeUVMap")
-    uv_map.uv_map = "texture_uv_layers"
-
-    # TileUV > Divide
-    divide = TileUV.nodes.new("ShaderNodeVectorMath")
-    divide.operation = "DIVIDE"
-    divide.inputs[1].default_value = [num_tiles, 1, 0]
-
-    # TileUV > GroupOutput
-    _out = TileUV.nodes.new("NodeGroupOutput")
-    TileUV.outputs.new("NodeSocketVector", "Tile_UV")
-
-    TileUV.links.new(uv_map.outputs[0], divide.inputs[0])
-    TileUV.links.new(divide.outputs[0], _out.inputs[0])
-
     # ========================================================================
     # TileByXShift
     # ========================================================================
+    # The layers map holds raw tile indices: they're recovered exactly by rounding the channel (sampled
+    # as idx / 255) and used to shift the UV to the tile's rect within the tileset.
 
     TileByXShift = bpy.data.node_groups.new("TileByXShift", "ShaderNodeTree")
 
     # GroupInput
     _in = TileByXShift.nodes.new("NodeGroupInput")
-    TileByXShift.inputs.new("NodeSocketFloat", "X")
-
-    # TileUV
-    tile_uv = TileByXShift.nodes.new("ShaderNodeGroup")
-    tile_uv.node_tree = TileUV
-
-    # Add
+    TileByXShift.inputs.new("NodeSocketFloat", "TileIdx")
+
+    if object_tile_uv is None:
+        # UVMap
+        # TODO UVs can be directly retrived from terrain vertices.
+        uv_map = TileByXShift.nodes.new("ShaderNodeUVMap")
+        uv_map.uv_map = "texture_uv_layers"
+        tile_uv = uv_map.outputs[0]
+    else:
+        (scale, span) = object_tile_uv
+
+        # Object
+        obj = TileByXShift.nodes.new("ShaderNodeTexCoord")
+
+        # fract(Object * scale) * span
+        obj_scale = TileByXShift.nodes.new("ShaderNodeVectorMath")
+        obj_scale.operation = "MULTIPLY"
+        obj_scale.inputs[1].default_value = [scale, scale, 0]
+
+        fract = TileByXShift.nodes.new("ShaderNodeVectorMath")
+        fract.operation = "FRACTION"
+
+        fract_span = TileByXShift.nodes.new("ShaderNodeVectorMath")
+        fract_span.operation = "MULTIPLY"
+        fract_span.inputs[1].default_value = [span, span, 0]
+
+        TileByXShift.links.new(obj.outputs["Object"], obj_scale.inputs[0])
+        TileByXShift.links.new(obj_scale.outputs[0], fract.inputs[0])
+        TileByXShift.links.new(fract.outputs[0], fract_span.inputs[0])
+        tile_uv = fract_span.outputs[0]
+
+    # TileIdx * 255
+    denormalize = TileByXShift.nodes.new("ShaderNodeMath")
+    denormalize.operation = "MULTIPLY"
+    denormalize.inputs[1].default_value = 255
+
+    # Round
+    _round = TileByXShift.nodes.new("ShaderNodeMath")
+    _round.operation = "ROUND"
+
+    # (TileIdx, 0, 0)
+    shift = TileByXShift.nodes.new("ShaderNodeCombineXYZ")
+
+    # UV + Shift
     add = TileByXShift.nodes.new("ShaderNodeVectorMath")
     add.operation = "ADD"
 
+    # (UV + Shift) / (num_tiles, 1)
+    divide = TileByXShift.nodes.new("ShaderNodeVectorMath")
+    divide.operation = "DIVIDE"
+    divide.inputs[1].default_value = [num_tiles, 1, 1]
+
     # TilesetImgTex
     tileset_tex = TileByXShift.nodes.new("ShaderNodeTexImage")
     tileset_tex.image = tileset_img
@@ -77,9 +104,13 @@ def create_renderer(
     _out = TileByXShift.nodes.new("NodeGroupOutput")
     TileByXShift.outputs.new("NodeSocketVector", "Color")
 
-    TileByXShift.links.new(tile_uv.outputs[0], add.inputs[0])
-    TileByXShift.links.new(_in.outputs[0], add.inputs[1])
-    TileByXShift.links.new(add.outputs[0], tileset_tex.inputs[0])
+    TileByXShift.links.new(_in.outputs[0], denormalize.inputs[0])
+    TileByXShift.links.new(denormalize.outputs[0], _round.inputs[0])
+    TileByXShift.links.new(_round.outputs[0], shift.inputs["X"])
+    TileByXShift.links.new(tile_uv, add.inputs[0])
+    TileByXShift.links.new(shift.outputs[0], add.inputs[1])
+    TileByXShift.links.new(add.outputs[0], divide.inputs[0])
+    TileByXShift.links.new(divide.outputs[0], tileset_tex.inputs[0])
     TileByXShift.links.new(tileset_tex.outputs[0], _out.inputs[0])
 
     # ========================================================================
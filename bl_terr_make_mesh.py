@@ -1,5 +1,5 @@
 import bpy
-from lr2_terrain import *
+from lr2_terrain import LR2_Terrain
 import math
 
 
@@ -101,13 +101,146 @@ def create_material(obj_name: str):
     return material
 
 
-def make_mesh(name: str, terrain: LR2_Terrain):
+def create_heightfield(obj_name: str, terrain: LR2_Terrain, height_map_png: str, material):
+    """
+    Creates the Geometry Nodes tree that displaces a grid by the height map (see terr_bundler.create_height_map).
+    The grid has the extents of the mesh made by build_geometry, its resolution is an input of the modifier.
+
+    :param height_map_png: The path to the generated height map.
+    :param material:       The material assigned to the generated geometry.
+    """
+
+    height_map_img = bpy.data.images.load(height_map_png)
+    height_map_img.colorspace_settings.name = "Raw"
+
+    width = terrain.TerrainWidth
+    size = (width - 1) / width  # The last vertex of build_geometry is at (TerrainWidth - 1) / TerrainWidth.
+
+    Heightfield = bpy.data.node_groups.new(obj_name + "Heightfield", "GeometryNodeTree")
+
+    # GroupInput
+    _in = Heightfield.nodes.new("NodeGroupInput")
+    Heightfield.inputs.new("NodeSocketGeometry", "Geometry")
+    Heightfield.inputs.new("NodeSocketInt", "Resolution")
+    Heightfield.inputs.new("NodeSocketInt", "Viewport Resolution")
+
+    # Resolution = IsViewport ? ViewportResolution : Resolution
+    is_viewport = Heightfield.nodes.new("GeometryNodeIsViewport")
+
+    resolution_diff = Heightfield.nodes.new("ShaderNodeMath")
+    resolution_diff.operation = "SUBTRACT"
+
+    resolution = Heightfield.nodes.new("ShaderNodeMath")
+    resolution.operation = "MULTIPLY_ADD"
+
+    # Grid, moved so that it spans [0, size]
+    grid = Heightfield.nodes.new("GeometryNodeMeshGrid")
+    grid.inputs["Size X"].default_value = size
+    grid.inputs["Size Y"].default_value = size
+
+    transform = Heightfield.nodes.new("GeometryNodeTransform")
+    transform.inputs["Translation"].default_value = [size / 2, size / 2, 0]
+
+    # Position + half texel = UV, every vertex of a full resolution grid hits its texel center.
+    position = Heightfield.nodes.new("GeometryNodeInputPosition")
+
+    uv = Heightfield.nodes.new("ShaderNodeVectorMath")
+    uv.operation = "ADD"
+    uv.inputs[1].default_value = [0.5 / width, 0.5 / terrain.TerrainDepth, 0]
+
+    # HeightMapImgTex
+    height_map = Heightfield.nodes.new("GeometryNodeImageTexture")
+    height_map.inputs["Image"].default_value = height_map_img
+    height_map.interpolation = "Linear"
+    height_map.extension = "EXTEND"
+
+    # Sampled height (height / 0xffff) -> the Z of build_geometry.
+    height = Heightfield.nodes.new("ShaderNodeMath")
+    height.operation = "MULTIPLY"
+    height.inputs[1].default_value = 0xffff * terrain.FilterScale / width
+
+    offset = Heightfield.nodes.new("ShaderNodeCombineXYZ")
+
+    set_position = Heightfield.nodes.new("GeometryNodeSetPosition")
+
+    set_material = Heightfield.nodes.new("GeometryNodeSetMaterial")
+    set_material.inputs["Material"].default_value = material
+
+    # GroupOutput
+    _out = Heightfield.nodes.new("NodeGroupOutput")
+    Heightfield.outputs.new("NodeSocketGeometry", "Geometry")
+
+    Heightfield.links.new(_in.outputs["Viewport Resolution"], resolution_diff.inputs[0])
+    Heightfield.links.new(_in.outputs["Resolution"], resolution_diff.inputs[1])
+    Heightfield.links.new(is_viewport.outputs[0], resolution.inputs[0])
+    Heightfield.links.new(resolution_diff.outputs[0], resolution.inputs[1])
+    Heightfield.links.new(_in.outputs["Resolution"], resolution.inputs[2])
+    Heightfield.links.new(resolution.outputs[0], grid.inputs["Vertices X"])
+    Heightfield.links.new(resolution.outputs[0], grid.inputs["Vertices Y"])
+
+    Heightfield.links.new(grid.outputs["Mesh"], transform.inputs["Geometry"])
+    Heightfield.links.new(position.outputs[0], uv.inputs[0])
+    Heightfield.links.new(uv.outputs[0], height_map.inputs["Vector"])
+    Heightfield.links.new(height_map.outputs["Color"], height.inputs[0])
+    Heightfield.links.new(height.outputs[0], offset.inputs["Z"])
+    Heightfield.links.new(transform.outputs["Geometry"], set_position.inputs["Geometry"])
+    Heightfield.links.new(offset.outputs[0], set_position.inputs["Offset"])
+    Heightfield.links.new(set_position.outputs["Geometry"], set_material.inputs["Geometry"])
+    Heightfield.links.new(set_material.outputs["Geometry"], _out.inputs[0])
+
+    return Heightfield
+
+
+def make_heightfield(name: str, terrain: LR2_Terrain, height_map_png: str, viewport_resolution: int = 129):
+    """
+    Like make_mesh, but the terrain is generated by a Geometry Nodes modifier out of the height map:
+    no geometry is stored, the resolution can be lowered in the viewport while renders keep the full one.
+    The generated mesh has no UV map, the renderer must be created with object_tile_uv (see tile_uv_params).
+    """
+    layer = bpy.context.view_layer
+
+    # Object
+    obj_name = name.capitalize()
+
+    mesh = bpy.data.meshes.new(obj_name)
+    _object = bpy.data.objects.new(name=obj_name, object_data=mesh)
+
+    layer.active_layer_collection.collection.objects.link(_object)
+    layer.objects.active = _object
+    _object.select_set(True)
+
+    # Material
+    mat = create_material(obj_name)
+    bpy.ops.object.material_slot_add()
+    _object.material_slots[0].material = mat
+    mat.use_nodes = True
+
+    # Geometry Nodes
+    modifier = _object.modifiers.new("Heightfield", "NODES")
+    modifier.node_group = create_heightfield(obj_name, terrain, height_map_png, mat)
+
+    inputs = {_input.name: _input.identifier for _input in modifier.node_group.inputs}
+    modifier[inputs["Resolution"]] = terrain.TerrainWidth
+    modifier[inputs["Viewport Resolution"]] = viewport_resolution
+
+
+def tile_uv_params(terrain: LR2_Terrain):
+    """
+    :return: The (scale, span) such that fract(object * scale) * span is the UV build_geometry gives to the tiles.
+    """
+    return terrain.TerrainWidth / terrain.StepX, terrain.StepX / (terrain.StepX + 1)
+
+
+def make_mesh(name: str, terrain: LR2_Terrain, geometry=None):
+    """
+    :param geometry: The vertices, faces and UVs of the terrain if already built (e.g. shared by terr_server).
+    """
     layer = bpy.context.view_layer
 
     # Object
     obj_name = name.capitalize()
 
-    (vert, faces, uvs) = build_geometry(terrain)
+    (vert, faces, uvs) = geometry if geometry is not None else build_geometry(terrain)
     mesh = create_mesh(obj_name, vert, faces)
     _object = bpy.data.objects.new(name=obj_name, object_data=mesh)
 
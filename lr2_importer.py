@@ -2,13 +2,6 @@ import os
 from lr2_terrain import LR2_Terrain
 import terr_bundler
 
-import sys
-
-# ONLY if the script is executed under Blender.
-if "bpy" in sys.modules:
-    import bl_terr_make_mesh
-    import bl_terr_create_renderer
-
 
 def _solve_terrain_simplified_name(terrain_name: str):
     _dict = {
@@ -56,29 +49,93 @@ def bundle_terrain(
     (terr_path, terr_png_tex_path) = _solve_terrain_paths(lr2_gamedata_path, png_textures_pack_path, terrain_name)
 
     tdf_path = os.path.join(terr_path, "TERRDATA.TDF")
-    lr2_terr = LR2_Terrain.from_file(tdf_path)
+    lr2_terr = LR2_Terrain.from_file(tdf_path, guard_edges=False)
 
     terr_bundler.bundle(lr2_terr, terr_png_tex_path)
 
 
-def import_terrain(
+def export_terrain_rasters(
         lr2_gamedata_path: str,
         png_textures_pack_path: str,
-        terrain_name: str
+        terrain_name: str,
+        file_format: str = "png",
+        precision: str = "16bit"
 ):
     (terr_path, terr_png_tex_path) = _solve_terrain_paths(lr2_gamedata_path, png_textures_pack_path, terrain_name)
 
     tdf_path = os.path.join(terr_path, "TERRDATA.TDF")
-    lr2_terr = LR2_Terrain.from_file(tdf_path)
+    lr2_terr = LR2_Terrain.from_file(tdf_path, use_mmap=True, guard_edges=False)
+
+    terr_bundler.export_rasters(lr2_terr, os.path.join(terr_png_tex_path, "rasters"), file_format, precision)
+
 
-    (tileset_tex, num_tiles, layers_map_tex, alpha_map_tex) = terr_bundler.get_bundle_info(terr_png_tex_path)
+def bake_terrain(
+        lr2_gamedata_path: str,
+        png_textures_pack_path: str,
+        terrain_name: str,
+        kind: str = "albedo",
+        grid_resolution: int = 256
+):
+    import terr_baker
+
+    (terr_path, terr_png_tex_path) = _solve_terrain_paths(lr2_gamedata_path, png_textures_pack_path, terrain_name)
+
+    tdf_path = os.path.join(terr_path, "TERRDATA.TDF")
+    lr2_terr = LR2_Terrain.from_file(tdf_path, use_mmap=True, guard_edges=False)
+
+    terr_baker.bake(lr2_terr, terr_png_tex_path, os.path.join(terr_png_tex_path, "bake"), kind, grid_resolution, tileset_tier="source")
+
+
+def import_terrain(
+        lr2_gamedata_path: str,
+        png_textures_pack_path: str,
+        terrain_name: str,
+        tileset_tier=terr_bundler.DEFAULT_TILESET_TIER,
+        heightfield=False,
+        terrain_server=None
+):
+    """
+    :param terrain_server: The address of the terr_server to get the terrain from, None to load it from the file.
+    """
+    # ONLY under Blender, imported here to keep the bundler (outside Blender) light.
+    import bl_terr_make_mesh
+    import bl_terr_create_renderer
+
+    (terr_path, terr_png_tex_path) = _solve_terrain_paths(lr2_gamedata_path, png_textures_pack_path, terrain_name)
+
+    (tileset_tex, num_tiles, layers_map_tex, alpha_map_tex) = terr_bundler.get_bundle_info(terr_png_tex_path, tileset_tier)
 
     # Bundle errors
     if not os.path.isfile(tileset_tex) or not os.path.isfile(layers_map_tex) or not os.path.isfile(alpha_map_tex):
         raise Exception("Some of the bundle info are missing. Run this script outside Blender to generate them.")
 
-    if num_tiles <= 0:
-        raise Exception("num_tiles <= 0, is the PNG texture pack valid?")
+    if num_tiles <= 1:
+        raise Exception("No tile found, is the PNG texture pack valid?")
+
+    height_map_tex = terr_bundler.get_height_map_path(terr_png_tex_path)
+    if heightfield and not os.path.isfile(height_map_tex):
+        raise Exception("The height map is missing. Run this script outside Blender to generate it.")
 
-    bl_terr_make_mesh.make_mesh(terrain_name, lr2_terr)
-    bl_terr_create_renderer.create_renderer(tileset_tex, num_tiles, layers_map_tex, alpha_map_tex)
+    tdf_path = os.path.join(terr_path, "TERRDATA.TDF")
+    if terrain_server is not None:
+        import terr_server
+        shared_terr = terr_server.attach(tdf_path, terrain_name, terrain_server)
+        (lr2_terr, geometry) = (shared_terr.terrain, shared_terr.geometry)
+    else:
+        shared_terr = None
+        lr2_terr = LR2_Terrain.from_file(tdf_path, guard_edges=False)
+        geometry = None
+
+    if heightfield:
+        bl_terr_make_mesh.make_heightfield(terrain_name, lr2_terr, height_map_tex)
+        object_tile_uv = bl_terr_make_mesh.tile_uv_params(lr2_terr)
+    else:
+        bl_terr_make_mesh.make_mesh(terrain_name, lr2_terr, geometry)
+        object_tile_uv = None
+
+    # Blender has copied what it needed, the shared terrain can be released.
+    if shared_terr is not None:
+        del lr2_terr, geometry
+        shared_terr.close()
+
+    bl_terr_create_renderer.create_renderer(tileset_tex, num_tiles, layers_map_tex, alpha_map_tex, object_tile_uv)
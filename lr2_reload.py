@@ -0,0 +1,62 @@
+import importlib
+import os
+import sys
+
+
+# The modules in dependency order, with their dependencies.
+MODULES = (
+    ("lr2_terrain", ()),
+    ("terr_bundler", ("lr2_terrain",)),
+    ("terr_validator", ("lr2_terrain",)),
+    ("terr_server", ("lr2_terrain",)),
+    ("terr_baker", ("lr2_terrain", "terr_bundler")),
+    ("bl_terr_make_mesh", ("lr2_terrain",)),
+    ("bl_terr_create_renderer", ()),
+    ("lr2_importer", ("lr2_terrain", "terr_bundler", "terr_server", "terr_baker", "bl_terr_make_mesh", "bl_terr_create_renderer")),
+)
+
+
+def _source_mtime(module):
+    return os.path.getmtime(module.__file__)
+
+
+def stamp():
+    """
+    Records the sources mtime of the loaded modules, to be called once they've been (re)loaded.
+    """
+    for name, _ in MODULES:
+        module = sys.modules.get(name)
+        if module is not None:
+            module.__lr2_mtime__ = _source_mtime(module)
+
+
+def reload_changed():
+    """
+    Reloads the loaded modules whose sources changed since the last stamp() (or that were never stamped),
+    along with the modules depending on them. Modules that aren't loaded yet are left to the next import.
+
+    This module is reloaded first if its sources changed, so that changes to MODULES are picked up too.
+
+    :return: The names of the reloaded modules.
+    """
+    this = sys.modules[__name__]
+    if _source_mtime(this) != __lr2_mtime__:
+        importlib.reload(this)  # Stamps it again, see below
+        return ["lr2_reload"] + this.reload_changed()
+
+    reloaded = []
+    for name, dependencies in MODULES:
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+
+        changed = getattr(module, "__lr2_mtime__", None) != _source_mtime(module)
+        if changed or any(dependency in reloaded for dependency in dependencies):
+            importlib.reload(module)
+            reloaded.append(name)
+
+    stamp()
+    return reloaded
+
+
+__lr2_mtime__ = _source_mtime(sys.modules[__name__])
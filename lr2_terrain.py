@@ -1,11 +1,20 @@
-from ctypes import *
-from typing import *
+# Annotations aren't evaluated, so that typing isn't imported.
+from __future__ import annotations
+
+from ctypes import Structure, POINTER, sizeof, c_bool, c_float, c_int8, c_int16, c_int32, c_uint8, c_uint16, c_uint32
+import io
+import mmap
 import os
 
 
 def read_ctype(file, ctype, verbose=False):
     size = sizeof(ctype)
-    c_obj = ctype.from_buffer(bytearray(file.read(size)))
+    if isinstance(file, mmap.mmap):
+        # Maps the ctype straight onto the file's pages, no copy is done.
+        c_obj = ctype.from_buffer(file, file.tell())
+        file.seek(size, os.SEEK_CUR)
+    else:
+        c_obj = ctype.from_buffer(bytearray(file.read(size)))
     if verbose:
         print("Read %s (%d)" % (ctype, size))
     if hasattr(c_obj, "value"):
@@ -13,6 +22,12 @@ def read_ctype(file, ctype, verbose=False):
     return c_obj
 
 
+def write_ctype(file, c_obj, verbose=False):
+    file.write(c_obj)
+    if verbose:
+        print("Wrote %s (%d)" % (type(c_obj), sizeof(c_obj)))
+
+
 class Vector(Structure):
     _fields_ = [
         ('x', c_float),
@@ -89,6 +104,75 @@ class sTerrGridInf(Structure):
     ]
 
 
+# ================================================================================================
+# NumPy views
+# ================================================================================================
+# The dtypes below mirror the ctypes structures (offsets are taken from them) so that the loaded
+# buffers can be viewed as NumPy arrays without copying. Bitfields are exposed as their storage.
+
+HOLLOWED_BIT = 0
+INVISIBLE_POLY_BIT = 7
+
+CONTIGUOUS_TEXTURES_BIT = 0
+MAX_DETAIL_LEVEL_SHIFT = 1  # The 7 upper bits
+
+
+def hmap_point_dtype():
+    import numpy as np
+
+    return np.dtype({
+        "names": ["Height", "Normal", "Flags", "LayerAlpha"],
+        "formats": ["<u2", ("i1", 3), "u1", "<u2"],
+        "offsets": [
+            sHMapPoint.Height.offset,
+            sHMapPoint.NormalX.offset,
+            sHMapPoint.Hollowed.offset,
+            sHMapPoint.LayerAlpha.offset
+        ],
+        "itemsize": sizeof(sHMapPoint)
+    })
+
+
+def map_grid_dtype():
+    import numpy as np
+
+    return np.dtype({
+        "names": ["pHeightData", "NumX", "NumY", "pEdgeDataBase", "OriEdgeDataOffset", "MIPEdgeDataOffset", "EdgeMipped"],
+        "formats": ["<u4", "<i2", "<i2", "<u4", ("<i2", 4), ("<i2", 4), ("i1", 4)],
+        "offsets": [getattr(sMapGrid, name).offset for name in [
+            "pHeightData", "NumX", "NumY", "pEdgeDataBase", "OriEdgeDataOffset", "MIPEdgeDataOffset", "EdgeMipped"
+        ]],
+        "itemsize": sizeof(sMapGrid)
+    })
+
+
+def terr_grid_inf_dtype():
+    import numpy as np
+
+    # DetailFlags is the storage of the ContiguousTextures and MaxDetailLevel bitfields.
+    return np.dtype({
+        "names": ["CentrePos", "StartX", "StartY", "GridCorners", "GridHeightData", "Pad", "LayerTextureIndex", "DetailLevel", "ClipRender", "DetailFlags", "NumLayers"],
+        "formats": [("<f4", 3), "<i2", "<i2", ("<f4", (8, 4)), (map_grid_dtype(), 4), ("i1", 8), ("i1", 4), "i1", "i1", "u1", "i1"],
+        "offsets": [getattr(sTerrGridInf, name).offset for name in [
+            "CentrePos", "StartX", "StartY", "GridCorners", "GridHeightData", "Pad", "LayerTextureIndex", "DetailLevel", "ClipRender", "ContiguousTextures", "NumLayers"
+        ]],
+        "itemsize": sizeof(sTerrGridInf)
+    })
+
+
+def layer_alphas(points):
+    """
+    Unpacks the 4-bit layer alphas of the given points.
+
+    :param points: An array of hmap_point_dtype.
+    :return:       An uint8 array shaped (*points.shape, 4), values are in [0, 15].
+    """
+    import numpy as np
+
+    alpha = points["LayerAlpha"]
+    return np.stack([(alpha >> (4 * i)) & 0xf for i in range(0, 4)], axis=-1).astype(np.uint8)
+
+
 class LR2_Terrain:
     # Constants
     MagicNumber: int = ord('T') + (ord('D') << 8) + (ord('F') << 16) + (ord('1') << 24)
@@ -119,12 +203,22 @@ class LR2_Terrain:
     StepX: int
     StepY: int
 
-    pPointBase: Dict[int, POINTER(sHMapPoint)] = {}
-    pEdgeBase: Dict[int, POINTER(c_uint16)] = {}
-    pTerrGrids: Dict[int, sTerrGridInf] = {}
+    pPointBase: dict[int, POINTER(sHMapPoint)]
+    pEdgeBase: dict[int, POINTER(c_uint16)]
+    pTerrGrids: dict[int, sTerrGridInf]
+
+    # Whatever follows the grids info, kept to write the file back as it was.
+    Trailing: bytes = b""
+
+    HeaderSize: int = 8 * sizeof(c_int32)
+
+    # The (heights_digest, edges_digest) of the terrain when loaded, see check_edges.
+    LoadedDigests: tuple = None
 
     def __init__(self):
-        pass
+        self.pPointBase = {}
+        self.pEdgeBase = {}
+        self.pTerrGrids = {}
 
     def grid_idx(self, x, y) -> int:
         return x * self.NumGridsY + y
@@ -138,6 +232,38 @@ class LR2_Terrain:
         point_idx = y * map_grid.NumX + x
         return self.pPointBase[grid_lod][map_grid.pHeightData + point_idx]
 
+    def points_array(self, lod=0):
+        """
+        :return: A zero-copy view of the points of the given LOD, as an array of hmap_point_dtype.
+        """
+        import numpy as np
+        return np.frombuffer(self.pPointBase[lod], dtype=hmap_point_dtype())
+
+    def grids_array(self):
+        """
+        :return: A zero-copy view of the grids, as an array of terr_grid_inf_dtype indexed by grid_idx.
+        """
+        import numpy as np
+        return np.frombuffer(self.pTerrGrids, dtype=terr_grid_inf_dtype())
+
+    def grid_points(self, lod=0):
+        """
+        Gathers the points of every grid in one pass.
+
+        :return: An array of hmap_point_dtype shaped (NumGrids, NumY, NumX), indexed by grid_idx.
+        """
+        import numpy as np
+
+        map_grids = self.grids_array()["GridHeightData"][:, lod]
+        num_x = int(map_grids["NumX"][0])
+        num_y = int(map_grids["NumY"][0])
+        if np.any(map_grids["NumX"] != num_x) or np.any(map_grids["NumY"] != num_y):
+            raise Exception("Grids of LOD %d don't have the same size" % lod)
+
+        idx = map_grids["pHeightData"].astype(np.int64)[:, None, None]
+        idx = idx + np.arange(num_y)[None, :, None] * num_x + np.arange(num_x)[None, None, :]
+        return self.points_array(lod)[idx]
+
     def load_header(self, f):
         MagicNum = read_ctype(f, c_int32)
         if MagicNum != self.MagicNumber:
@@ -201,17 +327,236 @@ class LR2_Terrain:
                 pGrid = self.pTerrGrids[GridIdx].GridHeightData[MipLevel]
                 pGrid.pHeightData = int(pGrid.pHeightData / sizeof(sHMapPoint))
 
-    def load(self, f):
+    def load(self, f, guard_edges=True):
+        """
+        :param guard_edges: Hashes the LOD 0 heights and the edge tables, for the writers to refuse stale edge tables
+                            (see check_edges). It reads them all (paging in a mapped file): pass False when the terrain
+                            is only read.
+        """
         self.load_header(f)
         self.load_points(f)
         self.load_edges(f)
         self.load_terrain_grids_info(f)
+        self.Trailing = f.read()
+        if guard_edges:
+            self.LoadedDigests = (self.heights_digest(), self.edges_digest())
         return self
 
+    # ============================================================================================
+    # Writing
+    # ============================================================================================
+
+    def save_header(self, f):
+        write_ctype(f, c_int32(self.MagicNumber))
+
+        write_ctype(f, c_int32(self.NumTexLayers))
+        write_ctype(f, c_int32(self.TerrainWidth))
+        write_ctype(f, c_int32(self.TerrainDepth))
+
+        write_ctype(f, c_float(self.FilterScale))
+
+        write_ctype(f, c_int32(self.NumAllocatedMipXs))
+        write_ctype(f, c_int32(self.NumMipLevels))
+        write_ctype(f, c_int32(self.NumAllocatedMipEdges))
+
+    def save_points(self, f):
+        for MipLevel in range(0, self.NumAllocatedMipXs):
+            write_ctype(f, self.pPointBase[MipLevel])
+
+    def save_edges(self, f):
+        for MipLevel in range(0, len(self.pEdgeBase)):
+            write_ctype(f, self.pEdgeBase[MipLevel])
+
+    def stored_terrain_grids_info(self):
+        """
+        :return: A copy of the grids info as stored in the file (pHeightData is a byte offset, not a point index).
+        """
+        import numpy as np
+
+        pTerrGrids = (self.NumGrids * sTerrGridInf).from_buffer_copy(self.pTerrGrids)
+
+        map_grids = np.frombuffer(pTerrGrids, dtype=terr_grid_inf_dtype())["GridHeightData"]
+        map_grids["pHeightData"][:, :self.NumMipLevels] *= sizeof(sHMapPoint)
+        return pTerrGrids
+
+    def save_terrain_grids_info(self, f):
+        write_ctype(f, self.stored_terrain_grids_info())
+
+    def heights_digest(self):
+        import hashlib
+
+        PointSize = sizeof(sHMapPoint)
+        offset = sHMapPoint.Height.offset
+
+        points = memoryview(self.pPointBase[0]).cast("B")
+        return hashlib.sha1(bytes(points[offset::PointSize]) + bytes(points[offset + 1::PointSize])).hexdigest()
+
+    def edges_digest(self):
+        import hashlib
+
+        digest = hashlib.sha1()
+        for MipLevel in range(0, len(self.pEdgeBase)):
+            digest.update(memoryview(self.pEdgeBase[MipLevel]).cast("B"))
+        return digest.hexdigest()
+
+    def check_edges(self):
+        """
+        The edge tables can't be regenerated (load_edges only sizes them, their layout isn't decoded): raises if
+        the LOD 0 heights changed since the terrain was loaded, while the edge tables didn't. Terrains loaded
+        without guard_edges aren't checked.
+        """
+        if self.LoadedDigests is None:
+            return
+
+        (heights_digest, edges_digest) = self.LoadedDigests
+        if self.heights_digest() != heights_digest and self.edges_digest() == edges_digest:
+            raise Exception(
+                "The LOD 0 heights changed but the edge tables didn't, they would be stale "
+                "(pass allow_stale_edges=True to write them anyway)"
+            )
+
+    def save(self, f, allow_stale_edges=False):
+        if not allow_stale_edges:
+            self.check_edges()
+
+        self.save_header(f)
+        self.save_points(f)
+        self.save_edges(f)
+        self.save_terrain_grids_info(f)
+        f.write(self.Trailing)
+
+    def to_file(self, path, allow_stale_edges=False):
+        if not allow_stale_edges:
+            self.check_edges()
+
+        f = open(path, "wb")
+        try:
+            self.save(f, allow_stale_edges=True)
+        finally:
+            f.close()
+
+    def regenerate_mips(self, grid_indices=None):
+        """
+        Rebuilds the lower mip levels of the given grids from their LOD 0 points, by taking every other point
+        of the level above. The edge tables aren't regenerated (see check_edges).
+
+        :param grid_indices: The grid_idx of the grids to rebuild, all of them if None.
+        """
+        import numpy as np
+
+        if grid_indices is None:
+            grid_indices = np.arange(self.NumGrids)
+        grid_indices = np.asarray(grid_indices, dtype=np.int64)
+
+        map_grids = self.grids_array()["GridHeightData"][grid_indices]
+        for MipLevel in range(1, min(self.NumAllocatedMipXs, self.NumMipLevels, self.MAX_MIP_LEVELS)):
+            src = self.grid_points(MipLevel - 1)[grid_indices]
+            dst = src[:, ::2, ::2]
+
+            num_points = dst.shape[1] * dst.shape[2]
+            idx = map_grids["pHeightData"][:, MipLevel].astype(np.int64)[:, None] + np.arange(num_points)[None, :]
+            self.points_array(MipLevel)[idx] = dst.reshape(len(grid_indices), num_points)
+
+    def section_offsets(self):
+        """
+        :return: The file offsets of the points (by mip level), edges (by mip level) and grids info sections.
+        """
+        offset = self.HeaderSize
+
+        points = {}
+        for MipLevel in range(0, self.NumAllocatedMipXs):
+            points[MipLevel] = offset
+            offset += sizeof(self.pPointBase[MipLevel])
+
+        edges = {}
+        for MipLevel in range(0, len(self.pEdgeBase)):
+            edges[MipLevel] = offset
+            offset += sizeof(self.pEdgeBase[MipLevel])
+
+        return points, edges, offset
+
+    def patch_file(self, path, grid_indices=None, allow_stale_edges=False):
+        """
+        Writes the points and grids info of the given grids back in place, the rest of the file isn't touched.
+        The file must have the same layout (header) as the terrain.
+
+        :param grid_indices:      The grid_idx of the grids to write, if None they're found by comparing with the file.
+        :param allow_stale_edges: Writes the points even if the heights changed but the edge tables didn't.
+        :return:                  The grid_idx of the written grids.
+        """
+        if not allow_stale_edges:
+            self.check_edges()
+
+        f = open(path, "r+b")
+        try:
+            mm = mmap.mmap(f.fileno(), 0)
+            try:
+                grid_indices = self._patch(mm, path, grid_indices)
+                mm.flush()
+            finally:
+                mm.close()
+        finally:
+            f.close()
+        return [int(GridIdx) for GridIdx in grid_indices]
+
+    def _patch(self, mm, path, grid_indices):
+        import numpy as np
+
+        header = io.BytesIO()
+        self.save_header(header)
+        (points_offsets, _, grids_offset) = self.section_offsets()
+        if mm[:self.HeaderSize] != header.getvalue() or len(mm) != grids_offset + self.TerrGridDataSize + len(self.Trailing):
+            raise Exception("The terrain layout doesn't match the one of: %s" % path)
+
+        NumMips = min(self.NumAllocatedMipXs, self.NumMipLevels, self.MAX_MIP_LEVELS)
+        PointSize = sizeof(sHMapPoint)
+        GridInfSize = sizeof(sTerrGridInf)
+
+        pTerrGrids = np.frombuffer(self.stored_terrain_grids_info(), dtype=np.uint8).reshape(self.NumGrids, GridInfSize)
+        map_grids = self.grids_array()["GridHeightData"]
+
+        def grid_points_bytes(buffer, MipLevel):
+            num_points = int(map_grids["NumX"][0, MipLevel]) * int(map_grids["NumY"][0, MipLevel])
+            start = map_grids["pHeightData"][:, MipLevel].astype(np.int64)[:, None] * PointSize
+            idx = start + np.arange(num_points * PointSize)[None, :]
+            return np.frombuffer(buffer, dtype=np.uint8)[idx], start
+
+        if grid_indices is None:
+            file_grids = np.frombuffer(mm[grids_offset:grids_offset + self.TerrGridDataSize], dtype=np.uint8)
+            changed = np.any(pTerrGrids != file_grids.reshape(self.NumGrids, GridInfSize), axis=1)
+
+            for MipLevel in range(0, NumMips):
+                offset = points_offsets[MipLevel]
+                (points, _) = grid_points_bytes(self.pPointBase[MipLevel], MipLevel)
+                (file_points, _) = grid_points_bytes(mm[offset:offset + sizeof(self.pPointBase[MipLevel])], MipLevel)
+                changed |= np.any(points != file_points, axis=1)
+
+            grid_indices = np.nonzero(changed)[0]
+
+        for MipLevel in range(0, NumMips):
+            (points, start) = grid_points_bytes(self.pPointBase[MipLevel], MipLevel)
+            for GridIdx in grid_indices:
+                offset = points_offsets[MipLevel] + int(start[GridIdx, 0])
+                mm[offset:offset + points.shape[1]] = points[GridIdx].tobytes()
+
+        for GridIdx in grid_indices:
+            offset = grids_offset + int(GridIdx) * GridInfSize
+            mm[offset:offset + GridInfSize] = pTerrGrids[GridIdx].tobytes()
+
+        return grid_indices
+
     @staticmethod
-    def from_file(path):
+    def from_file(path, use_mmap=False, guard_edges=True):
+        """
+        :param use_mmap:    Maps the file (copy-on-write) instead of reading it, the sections are paged in lazily
+                            (unless guard_edges is set).
+        :param guard_edges: See load.
+        """
         f = open(path, "rb")
-        res = LR2_Terrain().load(f)
+        if use_mmap:
+            res = LR2_Terrain().load(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY), guard_edges)
+        else:
+            res = LR2_Terrain().load(f, guard_edges)
         f.close()
         return res
 
@@ -14,10 +14,9 @@ _dir = LR2_IMPORTER_PATH
 if _dir not in sys.path:
     sys.path.append(_dir)
 
-import lr2_importer
-
-import importlib
-importlib.reload(lr2_importer)
+# Re-running the script (e.g. in Blender) only reloads the modules whose sources changed.
+import lr2_reload
+lr2_reload.reload_changed()
 
 import lr2_importer
 
@@ -25,20 +24,38 @@ import lr2_importer
 def import_terrain(
         gamedata_path: str,
         png_pack_path: str,
-        terrain_name: str
+        terrain_name: str,
+        tileset_tier=256,
+        heightfield=False
 ):
     if len(sys.argv) > 1 and sys.argv[1] == 'bundle':
         lr2_importer.bundle_terrain(gamedata_path, png_pack_path, terrain_name)
         print(terrain_name + " bundled!")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bake':
+        # py main.py bake [albedo|alpha] [grid_resolution]
+        kind = sys.argv[2] if len(sys.argv) > 2 else "albedo"
+        grid_resolution = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+        lr2_importer.bake_terrain(gamedata_path, png_pack_path, terrain_name, kind, grid_resolution)
+        print(terrain_name + " baked!")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'export':
+        # py main.py export [png|raw|npy] [16bit|float]
+        lr2_importer.export_terrain_rasters(gamedata_path, png_pack_path, terrain_name, *sys.argv[2:4])
+        print(terrain_name + " rasters exported!")
     else:
-        lr2_importer.import_terrain(gamedata_path, png_pack_path, terrain_name)
+        lr2_importer.import_terrain(gamedata_path, png_pack_path, terrain_name, tileset_tier, heightfield)
         print(terrain_name + " imported!")
 
+    lr2_reload.stamp()  # Also stamps the modules imported lazily
+
 # ================================================================================================
 
 # Edit here
-import_terrain(
-    "C:\\Users\\rutayisire\\Desktop\\LR2\\GAMEDATA",
-    "C:\\Users\\rutayisire\\Desktop\\LR2\\LEGO Racers 2 Textures (PNG)",
-    "MARS"
-)
+# (guarded: the bake's worker processes import this script too)
+if __name__ == "__main__":
+    import_terrain(
+        "C:\\Users\\rutayisire\\Desktop\\LR2\\GAMEDATA",
+        "C:\\Users\\rutayisire\\Desktop\\LR2\\LEGO Racers 2 Textures (PNG)",
+        "MARS",
+        256,  # Tileset tier: 64, 128, 256 or "source"
+        False  # Heightfield: generates the terrain with Geometry Nodes (Blender >= 3.1)
+    )
@@ -0,0 +1,208 @@
+from lr2_terrain import LR2_Terrain, layer_alphas
+import json
+import os
+import terr_bundler
+
+
+BAKE_KINDS = ("albedo", "alpha")
+
+
+def get_udim(block_x: int, block_y: int):
+    return 1001 + block_x + 10 * block_y
+
+
+def get_bake_tile_path(out: str, kind: str, udim: int):
+    return os.path.join(out, "%s.%d.png" % (kind, udim))
+
+
+def bake_grid(tileset, tile_side: int, tile_ids, alphas, resolution: int, kind: str):
+    """
+    Bakes a grid, as the renderer would shade it: the layers' tiles blended by their alpha, the alpha being
+    bilinearly interpolated between the grid's points.
+
+    :param tileset:    The tileset, as an RGBA uint8 array (see terr_bundler.create_terrain_tileset).
+    :param tile_ids:   The tile id of each layer (0 being the empty tile).
+    :param alphas:     The layers alpha of the grid's points, shaped (NumY, NumX, 4) in [0, 1].
+    :param resolution: The side of the baked grid, in pixels.
+    :return:           The baked grid as an RGBA float32 array, shaped (resolution, resolution, 4), top row first.
+    """
+    import numpy as np
+
+    (num_y, num_x, _) = alphas.shape
+
+    # The grid's coordinates of the pixel centers, [0, num - 1]. Rows go from the top (max Y) to the bottom.
+    local_x = (np.arange(resolution) + 0.5) * (num_x - 1) / resolution
+    local_y = (num_y - 1) - (np.arange(resolution) + 0.5) * (num_y - 1) / resolution
+
+    # Alpha, bilinearly interpolated
+    x0 = np.minimum(local_x.astype(np.int64), num_x - 2)
+    y0 = np.minimum(local_y.astype(np.int64), num_y - 2)
+    fx = (local_x - x0)[None, :, None]
+    fy = (local_y - y0)[:, None, None]
+    (y0, x0) = (y0[:, None], x0[None, :])
+    alpha = (
+        alphas[y0, x0] * (1 - fx) * (1 - fy) + alphas[y0, x0 + 1] * fx * (1 - fy) +
+        alphas[y0 + 1, x0] * (1 - fx) * fy + alphas[y0 + 1, x0 + 1] * fx * fy
+    ).astype(np.float32)
+
+    if kind == "alpha":
+        return alpha
+
+    # The tiles UV is local / num (see bl_terr_make_mesh.build_geometry), V going up.
+    cols = np.clip((local_x / num_x * tile_side).astype(np.int64), 0, tile_side - 1)
+    rows = np.clip(((1 - local_y / num_y) * tile_side).astype(np.int64), 0, tile_side - 1)
+
+    # OpenGL blending of the layers, in order, over a transparent black.
+    out_rgb = np.zeros((resolution, resolution, 3), dtype=np.float32)
+    out_a = np.zeros((resolution, resolution, 1), dtype=np.float32)
+    for layer_idx in range(0, 4):
+        tile = tileset[rows[:, None], tile_ids[layer_idx] * tile_side + cols[None, :], :3].astype(np.float32) / 0xff
+        sa = alpha[:, :, layer_idx:layer_idx + 1]
+        out_rgb = sa * tile + (1 - sa) * out_rgb
+        out_a = sa + (1 - sa) * out_a
+
+    return np.concatenate([out_rgb, out_a], axis=-1)
+
+
+# ================================================================================================
+# Workers
+# ================================================================================================
+
+_tileset = None
+
+
+def _init_worker(tileset_path: str):
+    global _tileset
+    import numpy as np
+    from PIL import Image
+
+    if tileset_path is not None:
+        _tileset = np.asarray(Image.open(tileset_path).convert("RGBA"))
+
+
+def _bake_block(out_path: str, tile_ids, alphas, resolution: int, kind: str):
+    """
+    Bakes a block of grids into out_path. The block is written to a temporary file first, so that an
+    interrupted bake never leaves a partial tile behind.
+
+    :param tile_ids: Shaped (BlockX, BlockY, 4), indexed by [grid_x, grid_y].
+    :param alphas:   Shaped (BlockX, BlockY, NumY, NumX, 4), uint8 in [0, 15].
+    """
+    import numpy as np
+    from PIL import Image
+
+    (block_x, block_y) = tile_ids.shape[:2]
+    tile_side = _tileset.shape[0] if _tileset is not None else 0
+
+    block = np.empty((block_y * resolution, block_x * resolution, 4), dtype=np.uint8)
+    for grid_x in range(0, block_x):
+        for grid_y in range(0, block_y):
+            grid = bake_grid(_tileset, tile_side, tile_ids[grid_x, grid_y], alphas[grid_x, grid_y] / 0xf, resolution, kind)
+
+            row = (block_y - grid_y - 1) * resolution
+            col = grid_x * resolution
+            block[row:row + resolution, col:col + resolution] = np.clip(grid * 0xff + 0.5, 0, 0xff).astype(np.uint8)
+
+    tmp_path = out_path + ".tmp"
+    Image.fromarray(block).save(tmp_path, format="png")
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+# ================================================================================================
+# Bake
+# ================================================================================================
+
+def bake(
+        terrain: LR2_Terrain,
+        terr_png_textures: str,
+        out: str,
+        kind: str = "albedo",
+        grid_resolution: int = 256,
+        block_size: int = 4,
+        tileset_tier=terr_bundler.DEFAULT_TILESET_TIER,
+        max_workers=None
+):
+    """
+    Bakes the terrain texture into a UDIM set, a block of block_size x block_size grids per tile, so that
+    the whole texture (NumGridsX * grid_resolution pixels wide) is never held in memory. Blocks are baked
+    in parallel by a pool of processes.
+
+    The tile 1001 + u + 10 * v covers the grids [u * block_size, (u + 1) * block_size) along X and
+    [v * block_size, (v + 1) * block_size) along Y. Tiles already baked (with the same settings) are skipped,
+    so that an interrupted bake can be resumed by calling it again.
+
+    :param terrain:           The loaded TDF file.
+    :param terr_png_textures: The path to the terrain's PNG textures, already bundled.
+    :param out:               The directory where the tiles are written.
+    :param kind:              "albedo" (the blended tiles) or "alpha" (the upscaled alpha map).
+    :param grid_resolution:   The side of a grid, in pixels.
+    :param block_size:        The side of a tile, in grids.
+    :param tileset_tier:      The tileset tier to sample the tiles from.
+    :param max_workers:       The number of processes, the number of CPUs if None.
+    :return:                  The paths of the tiles.
+    """
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    if kind not in BAKE_KINDS:
+        raise Exception("Invalid bake kind: %s (must be one of %s)" % (kind, BAKE_KINDS))
+
+    if terrain.NumGridsX % block_size != 0 or terrain.NumGridsY % block_size != 0:
+        raise Exception("The block size (%d) must divide the number of grids" % block_size)
+
+    blocks_x = terrain.NumGridsX // block_size
+    blocks_y = terrain.NumGridsY // block_size
+    if blocks_x > 10:
+        raise Exception("Too many tiles along X for UDIMs: %d > 10" % blocks_x)
+
+    tileset_path = None
+    if kind == "albedo":
+        (tileset_path, _, _, _) = terr_bundler.get_bundle_info(terr_png_textures, tileset_tier)
+        if not os.path.isfile(tileset_path):
+            raise Exception("The tileset is missing, bundle the terrain first: %s" % tileset_path)
+
+    # The settings are kept along the tiles: resuming with different ones would mix up the tiles.
+    os.makedirs(out, exist_ok=True)
+    settings = {"kind": kind, "grid_resolution": grid_resolution, "block_size": block_size, "tileset_tier": tileset_tier}
+    settings_path = os.path.join(out, "%s.json" % kind)
+    if os.path.isfile(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) != settings:
+                raise Exception("%s was baked with different settings, remove it to bake again" % settings_path)
+    else:
+        with open(settings_path, "w") as f:
+            json.dump(settings, f)
+
+    # As for the alpha map, the alpha of the layers without a tile is zeroed.
+    grids = terrain.grids_array()
+    tile_ids = grids["LayerTextureIndex"].astype(np.int32) + 1
+    tile_ids[np.arange(4)[None, :] >= grids["NumLayers"][:, None]] = 0
+
+    alphas = layer_alphas(terrain.grid_points(0))
+    alphas[np.broadcast_to((tile_ids == 0)[:, None, None, :], alphas.shape)] = 0
+
+    tile_ids = tile_ids.reshape(terrain.NumGridsX, terrain.NumGridsY, 4)
+    alphas = alphas.reshape((terrain.NumGridsX, terrain.NumGridsY) + alphas.shape[1:])
+
+    paths = []
+    with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(tileset_path,)) as executor:
+        futures = []
+        for block_x in range(0, blocks_x):
+            for block_y in range(0, blocks_y):
+                path = get_bake_tile_path(out, kind, get_udim(block_x, block_y))
+                paths.append(path)
+                if os.path.isfile(path):
+                    print("Already baked: %s" % path)
+                    continue
+
+                grid_x = slice(block_x * block_size, (block_x + 1) * block_size)
+                grid_y = slice(block_y * block_size, (block_y + 1) * block_size)
+                futures.append(executor.submit(
+                    _bake_block, path, tile_ids[grid_x, grid_y], alphas[grid_x, grid_y], grid_resolution, kind
+                ))
+
+        for future in futures:
+            print("Baked: %s" % future.result())
+
+    return paths
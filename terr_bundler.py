@@ -1,17 +1,43 @@
-from lr2_terrain import *
-import re
+from __future__ import annotations
 
+from lr2_terrain import LR2_Terrain, layer_alphas, HOLLOWED_BIT, INVISIBLE_POLY_BIT
+import os
+
+
+# The tileset resolutions emitted by the bundler, "source" keeps the tiles' own resolution.
+TILESET_TIERS = (64, 128, 256, "source")
+DEFAULT_TILESET_TIER = 256
+
+
+def get_tileset_path(terr_png_textures: str, tier: int | str = DEFAULT_TILESET_TIER):
+    if tier not in TILESET_TIERS:
+        raise Exception("Invalid tileset tier: %s (must be one of %s)" % (tier, TILESET_TIERS))
+    return os.path.join(terr_png_textures, "tileset_%s.png" % tier)
+
+
+def get_height_map_path(terr_png_textures: str):
+    return os.path.join(terr_png_textures, "height_map.png")
+
+
+def get_bundle_info(terr_png_textures: str, tier: int | str = DEFAULT_TILESET_TIER):
+    import re  # Not imported by the bundler otherwise
 
-def get_bundle_info(terr_png_textures: str):
     return (
-        os.path.join(terr_png_textures, "tileset.png"),
-        len([file for file in os.listdir(terr_png_textures) if re.match(r'TEXTURE[0-9]+\.png$', file)]),  # num_tiles
+        get_tileset_path(terr_png_textures, tier),
+        len([file for file in os.listdir(terr_png_textures) if re.match(r'TEXTURE[0-9]+\.png$', file)]) + 1,  # num_tiles (including the empty one, as in the tileset)
         os.path.join(terr_png_textures, "layers_map.png"),
         os.path.join(terr_png_textures, "alpha_map.png")
     )
 
 
-def create_terrain_tileset(terrain_path: str, out: str):
+def create_terrain_tileset(terrain_path: str, tiers=TILESET_TIERS):
+    """
+    Creates one tileset per tier, every tile is decoded once and then resampled for each tier.
+
+    :param terrain_path: The path to the terrain's PNG textures.
+    :param tiers:        The tiers to emit, see TILESET_TIERS.
+    :return:             The number of tiles contained in the tilesets (including the NULL one).
+    """
     from PIL import Image
 
     num_tiles = 0
@@ -21,51 +47,67 @@ def create_terrain_tileset(terrain_path: str, out: str):
             break
         num_tiles += 1
 
-    num_tiles += 1  # Leaves space for the empty layer.
-
-    tile_side = 256
-    tileset = Image.new("RGBA", (tile_side * num_tiles, tile_side), color=(0, 0, 0, 255))
-
-    for tile_id in range(1, num_tiles):
+    # Image.open only reads the header, the pixels are decoded once below.
+    tiles = []
+    for tile_id in range(1, num_tiles + 1):
         path = os.path.join(terrain_path, "TEXTURE%i.png" % tile_id)
 
         tile = Image.open(path)
         if tile.width != tile.height:
             raise Exception("Tile isn't a quad:", path)
+        tiles.append(tile)
+
+    num_tiles += 1  # Leaves space for the empty layer.
+
+    source_side = max([tile.width for tile in tiles], default=1)
+
+    tilesets = {}
+    for tier in tiers:
+        tile_side = source_side if tier == "source" else tier
+        tilesets[tier] = Image.new("RGBA", (tile_side * num_tiles, tile_side), color=(0, 0, 0, 255))
 
-        if tile.width != tile_side:
-            tile = tile.resize((tile_side, tile_side))
-            #print("resized:", path)
+    for tile_id, tile in enumerate(tiles, start=1):
+        tile.load()
+        for tier, tileset in tilesets.items():
+            tile_side = tileset.height
+            resized = tile if tile.width == tile_side else tile.resize((tile_side, tile_side))
+            tileset.paste(resized, (tile_id * tile_side, 0))
+        tile.close()
 
-        tileset.paste(tile, (tile_id * 256, 0))
+    for tier, tileset in tilesets.items():
+        tileset.save(get_tileset_path(terrain_path, tier), format="png")
 
-    tileset.save(out, format="png")
     return num_tiles
 
 
+# The layers map holds raw tile indices on 8 bits per channel.
+MAX_TILES = 0xff + 1
+
+
 def create_layers_map(terrain: LR2_Terrain, num_tiles: int, out: str):
+    """
+    Creates a texel per grid whose channels are the tile indices of the grid's layers, as raw integers
+    (0 being the empty tile), so that the renderer can look them up exactly.
+    """
+    import numpy as np
     from PIL import Image
 
-    width = terrain.NumGridsX
-    height = terrain.NumGridsY
+    if num_tiles > MAX_TILES:
+        raise Exception("Too many tiles for the layers map: %d > %d" % (num_tiles, MAX_TILES))
 
-    img = Image.new("RGBA", (width, height))
+    grids = terrain.grids_array()
 
-    for grid_x in range(0, terrain.NumGridsX):
-        for grid_y in range(0, terrain.NumGridsY):
-            grid = terrain.grid_at(grid_x, grid_y)
+    tile_ids = grids["LayerTextureIndex"].astype(np.int32) + 1  # [-1, 11] -> [0, 12]
+    tile_ids[np.arange(4)[None, :] >= grids["NumLayers"][:, None]] = 0
 
-            rgba = [0, 0, 0, 0]
-            for layer_idx in range(0, grid.NumLayers):
-                tile_id = grid.LayerTextureIndex[layer_idx]  # [-1, 11]
-                tile_id += 1
-                tile_id /= num_tiles
+    grid_idx = np.arange(terrain.NumGrids)
+    grid_x = grid_idx // terrain.NumGridsY
+    grid_y = grid_idx % terrain.NumGridsY
 
-                rgba[layer_idx] = int(tile_id * 255)
+    layers_map = np.zeros((terrain.NumGridsY, terrain.NumGridsX, 4), dtype=np.uint8)
+    layers_map[terrain.NumGridsY - grid_y - 1, grid_x] = tile_ids
 
-            img.putpixel((grid_x, height - grid_y - 1), tuple(rgba))
-
-    img.save(out, format="png")
+    Image.fromarray(layers_map).save(out, format="png")
 
 
 def create_alpha_map(terrain: LR2_Terrain, out: str):
@@ -106,10 +148,22 @@ def create_alpha_map(terrain: LR2_Terrain, out: str):
     img.save(out, format="png")
 
 
+def create_height_map(terrain: LR2_Terrain, out: str):
+    """
+    Creates a 16-bit grayscale texture of the raw points height, a texel per point (see create_rasters).
+    """
+    import numpy as np
+    from PIL import Image
+
+    height = _stitch_grids(terrain, terrain.grid_points(0)["Height"])
+    Image.fromarray(np.ascontiguousarray(height)).save(out, format="png")
+
+
 def bundle(lr2_terrain: LR2_Terrain, terr_png_textures: str):
     """
     Having the terrain and the set of tiles that lies on it.
     This script creates 3 different textures that, if mixed up wisely, will give the whole terrain texture.
+    Plus the height map, used by the heightfield import mode.
 
     :param lr2_terrain:       Actually, the loaded TDF file.
     :param terr_png_textures: The path to the terrain's PNG textures.
@@ -118,11 +172,12 @@ def bundle(lr2_terrain: LR2_Terrain, terr_png_textures: str):
     if not os.path.isdir(terr_png_textures):
         raise Exception("Invalid path: %s" % terr_png_textures)
 
-    (tileset_path, _, layers_map_path, alpha_map_path) = get_bundle_info(terr_png_textures)
+    (_, _, layers_map_path, alpha_map_path) = get_bundle_info(terr_png_textures)
 
-    # Tileset
-    num_tiles = create_terrain_tileset(terr_png_textures, tileset_path)
-    print("Tileset (num_tiles=%d): %s" % (num_tiles, tileset_path))
+    # Tilesets
+    num_tiles = create_terrain_tileset(terr_png_textures)
+    for tier in TILESET_TIERS:
+        print("Tileset (num_tiles=%d, tier=%s): %s" % (num_tiles, tier, get_tileset_path(terr_png_textures, tier)))
 
     # Layers map
     create_layers_map(lr2_terrain, num_tiles, layers_map_path)
@@ -132,3 +187,114 @@ def bundle(lr2_terrain: LR2_Terrain, terr_png_textures: str):
     create_alpha_map(lr2_terrain, alpha_map_path)
     print("Alpha map: %s" % alpha_map_path)
 
+    # Height map
+    height_map_path = get_height_map_path(terr_png_textures)
+    create_height_map(lr2_terrain, height_map_path)
+    print("Height map: %s" % height_map_path)
+
+
+# ================================================================================================
+# Rasters export
+# ================================================================================================
+
+RASTER_FORMATS = ("png", "raw", "npy")
+RASTER_PRECISIONS = ("16bit", "float")
+
+
+def _stitch_grids(terrain: LR2_Terrain, values):
+    """
+    Lays out per-grid values on a single terrain-wide raster, flipped so that the first row is the top one
+    (as done for the alpha map).
+
+    :param values: An array shaped (NumGrids, NumY, NumX, ...), indexed by grid_idx.
+    :return:       An array shaped (TerrainDepth, TerrainWidth, ...).
+    """
+    import numpy as np
+
+    grids = terrain.grids_array()
+    (_, num_y, num_x) = values.shape[:3]
+
+    rows = grids["StartY"].astype(np.int64)[:, None, None] + np.arange(num_y)[None, :, None]
+    cols = grids["StartX"].astype(np.int64)[:, None, None] + np.arange(num_x)[None, None, :]
+
+    raster = np.zeros((terrain.TerrainDepth, terrain.TerrainWidth) + values.shape[3:], dtype=values.dtype)
+    raster[rows, cols] = values
+    return raster[::-1]
+
+
+def create_rasters(terrain: LR2_Terrain, precision: str = "16bit"):
+    """
+    Builds the heightmap, the hollow/invisible masks and a weight map per tile (splat maps) of the terrain.
+
+    With the "16bit" precision: the height is the raw sHMapPoint.Height (to be scaled by FilterScale), masks and
+    weights span [0, 0xffff]. With the "float" precision: the height is already scaled, masks and weights span [0, 1].
+
+    :return: A dict of name -> raster, the weight maps are named after their tile's PNG texture.
+    """
+    import numpy as np
+
+    if precision not in RASTER_PRECISIONS:
+        raise Exception("Invalid precision: %s (must be one of %s)" % (precision, RASTER_PRECISIONS))
+
+    points = terrain.grid_points(0)
+    layer_texture_index = terrain.grids_array()["LayerTextureIndex"].astype(np.int32)
+
+    # As for the alpha map, the alpha of the layers without a tile is zeroed.
+    alphas = layer_alphas(points)
+    alphas[np.broadcast_to(layer_texture_index[:, None, None, :] < 0, alphas.shape)] = 0
+
+    if precision == "16bit":
+        height = points["Height"]
+        to_mask = lambda bits: (bits.astype(np.uint16) * 0xffff)
+        to_weight = lambda alpha: (alpha.astype(np.uint16) * 0x1111)  # 0xf -> 0xffff
+    else:
+        height = points["Height"].astype(np.float32) * np.float32(terrain.FilterScale)
+        to_mask = lambda bits: bits.astype(np.float32)
+        to_weight = lambda alpha: alpha.astype(np.float32) / 0xf
+
+    rasters = {
+        "height": height,
+        "hollow_mask": to_mask((points["Flags"] >> HOLLOWED_BIT) & 1),
+        "invisible_mask": to_mask((points["Flags"] >> INVISIBLE_POLY_BIT) & 1)
+    }
+
+    # A tile can be used by a different layer in every grid, its weight is the one of the layer that holds it.
+    for tile_idx in np.unique(layer_texture_index[layer_texture_index >= 0]):
+        tile_alpha = np.where(layer_texture_index[:, None, None, :] == tile_idx, alphas, 0).max(axis=-1)
+        rasters["weight_TEXTURE%d" % (tile_idx + 1)] = to_weight(tile_alpha)
+
+    return {name: _stitch_grids(terrain, raster) for name, raster in rasters.items()}
+
+
+def export_rasters(terrain: LR2_Terrain, out: str, file_format: str = "png", precision: str = "16bit"):
+    """
+    Exports the terrain rasters (see create_rasters) so that they can be used without Blender.
+
+    :param terrain:     The loaded TDF file.
+    :param out:         The directory where rasters are written.
+    :param file_format: "png" (grayscale 16-bit, requires the "16bit" precision), "raw" (little-endian, shaped
+                        TerrainDepth x TerrainWidth) or "npy".
+    :param precision:   "16bit" or "float".
+    """
+    import numpy as np
+
+    if file_format not in RASTER_FORMATS:
+        raise Exception("Invalid format: %s (must be one of %s)" % (file_format, RASTER_FORMATS))
+
+    if file_format == "png" and precision != "16bit":
+        raise Exception("PNG rasters can only be exported with the 16bit precision")
+
+    os.makedirs(out, exist_ok=True)
+
+    for name, raster in create_rasters(terrain, precision).items():
+        path = os.path.join(out, "%s.%s" % (name, file_format))
+
+        if file_format == "png":
+            from PIL import Image
+            Image.fromarray(np.ascontiguousarray(raster)).save(path, format="png")
+        elif file_format == "raw":
+            raster.astype(raster.dtype.newbyteorder("<")).tofile(path)
+        else:
+            np.save(path, raster)
+
+        print("Raster (%dx%d): %s" % (raster.shape[1], raster.shape[0], path))
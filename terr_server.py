@@ -0,0 +1,413 @@
+"""
+A local service that loads every terrain once and shares it with the render workers through shared memory.
+
+The server decodes the TDF and builds the mesh arrays (the ones of bl_terr_make_mesh.build_geometry) into a
+shared memory segment per terrain, named after the terrain and its content hash. Workers attach to it
+without copying: the LR2_Terrain they get is backed by the segment and must be considered read-only.
+Segments are reference counted, by client connection: a worker holds its segment as long as its connection
+is open, so a worker that crashes releases it too. Unreferenced segments are evicted (least recently used
+first) once the server holds more than max_bytes. If the server isn't running, workers load the terrain from
+the file.
+
+Clients authenticate with a random key, created by the server in ~/.lr2_terrain_server.key (readable by its
+owner only): only the processes of the user running the server can talk to it.
+
+    py terr_server.py [max_mb]  # Runs the server
+
+Requires Python >= 3.8 (multiprocessing.shared_memory).
+"""
+
+# Annotations aren't evaluated, so that typing isn't imported.
+from __future__ import annotations
+
+from lr2_terrain import LR2_Terrain, sHMapPoint, sTerrGridInf
+from collections import OrderedDict
+from ctypes import sizeof, c_uint16
+from multiprocessing import AuthenticationError, shared_memory
+from multiprocessing.connection import Client, Listener
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import threading
+
+
+DEFAULT_ADDRESS = ("localhost", 47802)
+AUTH_KEY_PATH = os.path.join(os.path.expanduser("~"), ".lr2_terrain_server.key")
+
+HEADER_FIELDS = (
+    "NumTexLayers", "TerrainWidth", "TerrainDepth", "GridWidth", "GridHeight", "FilterScale",
+    "NumAllocatedMipXs", "NumMipLevels", "NumAllocatedMipEdges", "TerrGridDataSize", "StepX", "StepY"
+)
+
+ALIGNMENT = 16
+
+
+def build_geometry_arrays(terrain: LR2_Terrain):
+    """
+    Vectorized bl_terr_make_mesh.build_geometry: same vertices, faces and UVs, in the same order.
+
+    :return: The vertices (float32, Nx3), faces (int32, Mx3) and UVs (float32, Nx2) arrays.
+    """
+    import numpy as np
+
+    points = terrain.grid_points(0)  # (NumGrids, NumY, NumX)
+    grids = terrain.grids_array()
+    (num_grids, num_y, num_x) = points.shape
+    if num_x != 17 or num_y != 17:
+        raise Exception("LOD is not 0! num_x=%d num_y=%d" % (num_x, num_y))
+
+    # build_geometry iterates over pos_x, then over pos_y.
+    pos_x = np.arange(num_x)[:, None]
+    pos_y = np.arange(num_y)[None, :]
+    height = points["Height"].transpose(0, 2, 1)  # (NumGrids, NumX, NumY)
+
+    vertices = np.empty((num_grids, num_x, num_y, 3), dtype=np.float32)
+    vertices[..., 0] = (pos_x + grids["StartX"][:, None, None].astype(np.float64)) / terrain.TerrainWidth
+    vertices[..., 1] = (pos_y + grids["StartY"][:, None, None].astype(np.float64)) / terrain.TerrainWidth
+    vertices[..., 2] = height.astype(np.float64) * terrain.FilterScale / terrain.TerrainWidth
+
+    uvs = np.empty((num_grids, num_x, num_y, 2), dtype=np.float32)
+    uvs[..., 0] = np.broadcast_to(pos_x / num_x, (num_grids, num_x, num_y))
+    uvs[..., 1] = np.broadcast_to(pos_y / num_y, (num_grids, num_x, num_y))
+
+    # Faces, v_pool[0] = pos_x + pos_y * num_x (iterating over pos_x, then over pos_y).
+    v0 = (np.arange(num_x - 1)[:, None] + np.arange(num_y - 1)[None, :] * num_x).reshape(-1)
+    quad = np.stack([
+        np.stack([v0, v0 + 1, v0 + num_x], axis=-1),
+        np.stack([v0 + num_x, v0 + 1, v0 + num_x + 1], axis=-1)
+    ], axis=1).reshape(-1, 3)
+    faces = (quad[None, :, :] + (np.arange(num_grids) * num_x * num_y)[:, None, None]).astype(np.int32)
+
+    return vertices.reshape(-1, 3), faces.reshape(-1, 3), uvs.reshape(-1, 2)
+
+
+def terrain_hash(tdf_path: str):
+    f = open(tdf_path, "rb")
+    digest = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return digest[:16]
+
+
+def segment_name(terrain_name: str, content_hash: str):
+    return "lr2_%s_%s" % (re.sub(r"[^A-Za-z0-9]", "_", terrain_name), content_hash)
+
+
+# ================================================================================================
+# Segment layout
+# ================================================================================================
+# [manifest size: uint32][manifest: JSON][arrays, aligned to ALIGNMENT]
+# The manifest holds the header fields and the offset/size (and dtype/shape for NumPy arrays) of every array.
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _create_segment(name: str, terrain: LR2_Terrain, geometry):
+    import numpy as np
+
+    buffers = {}
+    for MipLevel, pPoints in terrain.pPointBase.items():
+        buffers["points_%d" % MipLevel] = pPoints
+    for MipLevel, pEdges in terrain.pEdgeBase.items():
+        buffers["edges_%d" % MipLevel] = pEdges
+    buffers["grids"] = terrain.pTerrGrids
+    buffers["trailing"] = terrain.Trailing
+    for array_name, array in zip(("vertices", "faces", "uvs"), geometry):
+        buffers[array_name] = np.ascontiguousarray(array)
+
+    manifest = {"header": {field: getattr(terrain, field) for field in HEADER_FIELDS}, "arrays": {}}
+
+    # The offsets depend on the manifest size, that depends on the offsets: the manifest is sized for the worst case.
+    offset = 0
+    for buffer_name, buffer in buffers.items():
+        entry = {"offset": offset, "size": memoryview(buffer).nbytes}
+        if isinstance(buffer, np.ndarray):
+            entry["dtype"] = buffer.dtype.str
+            entry["shape"] = buffer.shape
+        manifest["arrays"][buffer_name] = entry
+        offset = _align(offset + entry["size"])
+
+    data_offset = _align(4 + len(json.dumps(manifest)) + 32 * len(buffers))
+    for entry in manifest["arrays"].values():
+        entry["offset"] += data_offset
+    manifest_bytes = json.dumps(manifest).encode()
+    if 4 + len(manifest_bytes) > data_offset:
+        raise Exception("Manifest doesn't fit: %d > %d" % (4 + len(manifest_bytes), data_offset))
+
+    shm = shared_memory.SharedMemory(name=name, create=True, size=data_offset + offset)
+    shm.buf[0:4] = struct.pack("<I", len(manifest_bytes))
+    shm.buf[4:4 + len(manifest_bytes)] = manifest_bytes
+    for buffer_name, buffer in buffers.items():
+        entry = manifest["arrays"][buffer_name]
+        shm.buf[entry["offset"]:entry["offset"] + entry["size"]] = memoryview(buffer).cast("B")
+    return shm
+
+
+def _read_segment(shm):
+    """
+    :return: The LR2_Terrain and the geometry arrays, backed by the segment.
+    """
+    import numpy as np
+
+    (manifest_size,) = struct.unpack("<I", bytes(shm.buf[0:4]))
+    manifest = json.loads(bytes(shm.buf[4:4 + manifest_size]))
+    arrays = manifest["arrays"]
+
+    terrain = LR2_Terrain()
+    for field, value in manifest["header"].items():
+        setattr(terrain, field, value)
+
+    for MipLevel in range(0, terrain.NumAllocatedMipXs):
+        entry = arrays["points_%d" % MipLevel]
+        terrain.pPointBase[MipLevel] = (entry["size"] // sizeof(sHMapPoint) * sHMapPoint).from_buffer(shm.buf, entry["offset"])
+
+    MipLevel = 0
+    while "edges_%d" % MipLevel in arrays:
+        entry = arrays["edges_%d" % MipLevel]
+        terrain.pEdgeBase[MipLevel] = (entry["size"] // sizeof(c_uint16) * c_uint16).from_buffer(shm.buf, entry["offset"])
+        MipLevel += 1
+
+    entry = arrays["grids"]
+    terrain.pTerrGrids = (terrain.NumGrids * sTerrGridInf).from_buffer(shm.buf, entry["offset"])
+
+    entry = arrays["trailing"]
+    terrain.Trailing = bytes(shm.buf[entry["offset"]:entry["offset"] + entry["size"]])
+
+    geometry = []
+    for array_name in ("vertices", "faces", "uvs"):
+        entry = arrays[array_name]
+        count = int(np.prod(entry["shape"]))
+        array = np.frombuffer(shm.buf, dtype=np.dtype(entry["dtype"]), count=count, offset=entry["offset"])
+        geometry.append(array.reshape(entry["shape"]))
+
+    return terrain, tuple(geometry)
+
+
+# ================================================================================================
+# Server
+# ================================================================================================
+
+def get_auth_key(create=False):
+    """
+    The key clients authenticate with, a per-user secret readable by its owner only: connections unpickle what
+    they receive, so the server must only talk to the processes of its user.
+
+    :param create: Creates the key if it doesn't exist (the server does, the workers only read it).
+    """
+    if create and not os.path.isfile(AUTH_KEY_PATH):
+        fd = os.open(AUTH_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+
+    f = open(AUTH_KEY_PATH, "rb")
+    key = f.read()
+    f.close()
+    return key
+
+
+class TerrainServer:
+    def __init__(self, address=DEFAULT_ADDRESS, max_bytes=1024 * 1024 * 1024):
+        self.address = address
+        self.max_bytes = max_bytes
+
+        self.segments: OrderedDict[str, shared_memory.SharedMemory] = OrderedDict()  # Least recently used first
+        self.ref_counts: dict[str, int] = {}
+        self.hashes: dict[tuple[str, int, int], str] = {}  # (path, mtime, size) -> content hash
+        self.lock = threading.Lock()
+
+    def _hash(self, tdf_path: str):
+        stat = os.stat(tdf_path)
+        key = (os.path.abspath(tdf_path), stat.st_mtime_ns, stat.st_size)
+        if key not in self.hashes:
+            self.hashes[key] = terrain_hash(tdf_path)
+        return self.hashes[key]
+
+    def acquire(self, tdf_path: str, terrain_name: str):
+        name = segment_name(terrain_name, self._hash(tdf_path))
+
+        if name not in self.segments:
+            terrain = LR2_Terrain.from_file(tdf_path, guard_edges=False)
+            self.segments[name] = _create_segment(name, terrain, build_geometry_arrays(terrain))
+            self.ref_counts[name] = 0
+            print("Published %s (%d bytes)" % (name, self.segments[name].size))
+
+        self.segments.move_to_end(name)
+        self.ref_counts[name] += 1
+        self.evict()
+        return name
+
+    def release(self, name: str):
+        if self.ref_counts.get(name, 0) > 0:
+            self.ref_counts[name] -= 1
+        self.evict()
+
+    def evict(self):
+        total = sum(shm.size for shm in self.segments.values())
+        for name in list(self.segments):
+            if total <= self.max_bytes:
+                break
+            if self.ref_counts[name] > 0:
+                continue
+
+            shm = self.segments.pop(name)
+            del self.ref_counts[name]
+            total -= shm.size
+            shm.close()
+            shm.unlink()
+            print("Evicted %s" % name)
+
+    def close(self):
+        for shm in self.segments.values():
+            shm.close()
+            shm.unlink()
+        self.segments.clear()
+        self.ref_counts.clear()
+
+    def _handle(self, conn):
+        """
+        Serves a client until it disconnects. The references are held by the connection: they're released once
+        it's closed, even if the client crashed without releasing them.
+        """
+        held = []
+        try:
+            while True:
+                try:
+                    (command, *args) = conn.recv()
+                except Exception:  # Disconnected, or a malformed message
+                    break
+
+                try:
+                    with self.lock:
+                        if command == "acquire":
+                            result = self.acquire(*args)
+                            held.append(result)
+                        elif command == "release":
+                            if args[0] not in held:
+                                raise Exception("Not acquired: %s" % args[0])
+                            held.remove(args[0])
+                            self.release(*args)
+                            result = None
+                        elif command == "stats":
+                            result = dict(self.ref_counts)
+                        else:
+                            raise Exception("Unknown command: %s" % command)
+                    reply = ("ok", result)
+                except Exception as e:
+                    reply = ("error", str(e))
+
+                try:
+                    conn.send(reply)
+                except OSError:
+                    break
+        finally:
+            conn.close()
+            with self.lock:
+                for name in held:
+                    self.release(name)
+
+    def serve_forever(self):
+        listener = Listener(self.address, authkey=get_auth_key(create=True))
+        print("Terrain server listening on %s:%d" % self.address)
+        try:
+            while True:
+                # A client failing the handshake (or going away during it) mustn't stop the server.
+                try:
+                    conn = listener.accept()
+                except (EOFError, OSError, AuthenticationError) as e:
+                    print("Connection refused: %r" % e)
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            with self.lock:
+                self.close()
+
+
+def _request(conn, *message):
+    conn.send(message)
+    (status, result) = conn.recv()
+    if status != "ok":
+        raise Exception("Terrain server: %s" % result)
+    return result
+
+
+# ================================================================================================
+# Workers
+# ================================================================================================
+
+class SharedTerrain:
+    """
+    A terrain attached to the server's shared memory (or loaded from the file, if the server isn't running).
+    The connection to the server is kept open until close(): the server holds the segment as long as it lives.
+
+    :ivar terrain:  The LR2_Terrain, read-only.
+    :ivar geometry: The vertices, faces and UVs arrays (see build_geometry_arrays), read-only.
+    """
+
+    def __init__(self, terrain: LR2_Terrain, geometry, shm=None, conn=None):
+        self.terrain = terrain
+        self.geometry = geometry
+        self.shm = shm
+        self.conn = conn
+
+    @property
+    def is_shared(self):
+        return self.shm is not None
+
+    def close(self):
+        if self.shm is None:
+            return
+
+        name = self.shm.name
+        # The views must be gone before the segment can be closed.
+        self.terrain = None
+        self.geometry = None
+        self.shm.close()
+        self.shm = None
+        try:
+            _request(self.conn, "release", name)
+        finally:
+            self.conn.close()
+            self.conn = None
+
+
+def _attach_segment(name: str):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # Otherwise the worker's resource tracker would unlink the server's segment when the worker exits.
+        # Windows segments aren't tracked (and the tracker can't be started there).
+        if os.name == "posix":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def attach(tdf_path: str, terrain_name: str, address=DEFAULT_ADDRESS):
+    """
+    :return: A SharedTerrain, to close once done with it.
+    """
+    try:
+        conn = Client(address, authkey=get_auth_key())
+    except (OSError, AuthenticationError):
+        print("Terrain server not available, loading: %s" % tdf_path)
+        terrain = LR2_Terrain.from_file(tdf_path, guard_edges=False)
+        return SharedTerrain(terrain, build_geometry_arrays(terrain))
+
+    try:
+        name = _request(conn, "acquire", os.path.abspath(tdf_path), terrain_name)
+        shm = _attach_segment(name)
+        (terrain, geometry) = _read_segment(shm)
+    except BaseException:
+        conn.close()  # Releases the segment, if it was acquired
+        raise
+    return SharedTerrain(terrain, geometry, shm, conn)
+
+
+if __name__ == "__main__":
+    max_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    TerrainServer(max_bytes=max_mb * 1024 * 1024).serve_forever()
@@ -0,0 +1,219 @@
+from lr2_terrain import LR2_Terrain, layer_alphas
+import sys
+
+
+HEADER_FIELDS = ("NumTexLayers", "TerrainWidth", "TerrainDepth", "FilterScale", "NumAllocatedMipXs", "NumMipLevels", "NumAllocatedMipEdges")
+
+GRID_FIELDS = ("CentrePos", "StartX", "StartY", "GridCorners", "Pad", "LayerTextureIndex", "DetailLevel", "ClipRender", "DetailFlags", "NumLayers")
+MAP_GRID_FIELDS = ("pHeightData", "NumX", "NumY", "pEdgeDataBase", "OriEdgeDataOffset", "MIPEdgeDataOffset", "EdgeMipped")
+POINT_FIELDS = ("Height", "Normal", "Flags", "LayerAlpha")
+
+
+def _grid_name(terrain: LR2_Terrain, grid_idx):
+    return "Grid[%d][%d]" % (grid_idx // terrain.NumGridsY, grid_idx % terrain.NumGridsY)
+
+
+def _num_grid_mips(terrain: LR2_Terrain):
+    return min(terrain.NumAllocatedMipXs, terrain.NumMipLevels, terrain.MAX_MIP_LEVELS)
+
+
+def _mip_sizes(terrain: LR2_Terrain):
+    """
+    :return: The expected (NumX, NumY) of the grids, by mip level.
+    """
+    sizes = []
+    MipWidth = terrain.StepX + 1
+    MipHeight = terrain.StepY + 1
+    for MipLevel in range(0, _num_grid_mips(terrain)):
+        sizes.append((MipWidth, MipHeight))
+        MipWidth = int((MipWidth - 1) / 2) + 1
+        MipHeight = int((MipHeight - 1) / 2) + 1
+    return sizes
+
+
+def _valid_grids(terrain: LR2_Terrain, MipLevel: int):
+    """
+    :return: A bool per grid telling whether its points at the given LOD have the expected size and lie in the point buffer.
+    """
+    import numpy as np
+
+    (num_x, num_y) = _mip_sizes(terrain)[MipLevel]
+    map_grids = terrain.grids_array()["GridHeightData"][:, MipLevel]
+    end = map_grids["pHeightData"].astype(np.int64) + num_x * num_y
+    return (map_grids["NumX"] == num_x) & (map_grids["NumY"] == num_y) & (end <= len(terrain.pPointBase[MipLevel]))
+
+
+def _gather_points(terrain: LR2_Terrain, MipLevel: int, mask):
+    """
+    :return: The points of the masked grids (see _valid_grids) at the given LOD, shaped (NumMasked, NumY * NumX).
+    """
+    import numpy as np
+
+    (num_x, num_y) = _mip_sizes(terrain)[MipLevel]
+    map_grids = terrain.grids_array()["GridHeightData"][mask, MipLevel]
+    idx = map_grids["pHeightData"].astype(np.int64)[:, None] + np.arange(num_x * num_y)[None, :]
+    return terrain.points_array(MipLevel)[idx]
+
+
+def _differing(a, b):
+    """
+    :return: A bool per row (first axis) telling whether the rows of the two arrays differ.
+    """
+    import numpy as np
+
+    a = np.ascontiguousarray(a).reshape(len(a), -1)
+    b = np.ascontiguousarray(b).reshape(len(b), -1)
+    if a.dtype.kind == "f":
+        # Bitwise, so that NaNs compare equal to themselves and -0.0 differs from 0.0
+        a = a.view("<u%d" % a.dtype.itemsize)
+        b = b.view("<u%d" % b.dtype.itemsize)
+    return np.any(a != b, axis=1)
+
+
+def validate(terrain: LR2_Terrain):
+    """
+    Checks the terrain is internally consistent.
+
+    :return: The list of the integrity errors found, empty if the terrain is valid.
+    """
+    import numpy as np
+
+    errors = []
+
+    def report(mask, message):
+        for grid_idx in np.nonzero(mask)[0]:
+            errors.append("%s: %s" % (_grid_name(terrain, grid_idx), message))
+
+    grids = terrain.grids_array()
+    map_grids = grids["GridHeightData"]
+
+    # Grid sizes and point offsets, by mip level
+    for MipLevel, (MipWidth, MipHeight) in enumerate(_mip_sizes(terrain)):
+        num_x = map_grids["NumX"][:, MipLevel]
+        num_y = map_grids["NumY"][:, MipLevel]
+        report((num_x != MipWidth) | (num_y != MipHeight), "NumX/NumY at LOD %d aren't %dx%d" % (MipLevel, MipWidth, MipHeight))
+
+        num_points = len(terrain.pPointBase[MipLevel])
+        end = map_grids["pHeightData"][:, MipLevel].astype(np.int64) + num_x.astype(np.int64) * num_y
+        overflow = (end > num_points) | (num_x < 0) | (num_y < 0)
+        report(overflow, "pHeightData at LOD %d runs past the point buffer (%d points)" % (MipLevel, num_points))
+
+    # Grids placement
+    grid_idx = np.arange(terrain.NumGrids)
+    report(grids["StartX"] != (grid_idx // terrain.NumGridsY) * terrain.StepX, "StartX doesn't match the grid position")
+    report(grids["StartY"] != (grid_idx % terrain.NumGridsY) * terrain.StepY, "StartY doesn't match the grid position")
+
+    # Layers
+    layer_texture_index = grids["LayerTextureIndex"].astype(np.int32)
+    report((grids["NumLayers"] < 0) | (grids["NumLayers"] > 4), "NumLayers isn't in [0, 4]")
+
+    layer_idx = np.arange(4)[None, :]
+    unused_layer = layer_idx >= grids["NumLayers"][:, None]
+    report(np.any(unused_layer & (layer_texture_index >= 0), axis=1), "LayerTextureIndex is set on layers past NumLayers")
+
+    # The points of the grids whose sizes or offsets are broken can't be checked.
+    in_bounds = _valid_grids(terrain, 0)
+    if np.any(in_bounds):
+        alphas = layer_alphas(_gather_points(terrain, 0, in_bounds))
+
+        no_tile = np.zeros((terrain.NumGrids, 4), dtype=bool)
+        no_tile[in_bounds] = np.any(alphas > 0, axis=1) & (layer_texture_index[in_bounds] < 0)
+        for layer in range(0, 4):
+            report(no_tile[:, layer], "alpha set on layer %d, whose LayerTextureIndex is -1" % layer)
+
+    return errors
+
+
+def diff(a: LR2_Terrain, b: LR2_Terrain):
+    """
+    Compares two terrains field by field.
+
+    :return: The list of the differences found, empty if the terrains are the same.
+    """
+    import numpy as np
+
+    diffs = []
+
+    for field in HEADER_FIELDS:
+        if getattr(a, field) != getattr(b, field):
+            diffs.append("Header: %s %s != %s" % (field, getattr(a, field), getattr(b, field)))
+
+    # Differently shaped terrains can't be compared grid by grid.
+    if diffs:
+        return diffs
+
+    differing = {}  # grid_idx -> [field, ...]
+
+    def collect(mask, field):
+        for grid_idx in np.nonzero(mask)[0]:
+            differing.setdefault(grid_idx, []).append(field)
+
+    grids_a = a.grids_array()
+    grids_b = b.grids_array()
+    for field in GRID_FIELDS:
+        collect(_differing(grids_a[field], grids_b[field]), field)
+
+    for MipLevel in range(0, _num_grid_mips(a)):
+        map_grids_a = grids_a["GridHeightData"][:, MipLevel]
+        map_grids_b = grids_b["GridHeightData"][:, MipLevel]
+        for field in MAP_GRID_FIELDS:
+            collect(_differing(map_grids_a[field], map_grids_b[field]), "GridHeightData[%d].%s" % (MipLevel, field))
+
+        # Points are compared where both terrains have valid grids, validate() reports the others.
+        valid = _valid_grids(a, MipLevel) & _valid_grids(b, MipLevel)
+        collect(~valid, "LOD %d points not compared (invalid grid)" % MipLevel)
+
+        points_a = _gather_points(a, MipLevel, valid)
+        points_b = _gather_points(b, MipLevel, valid)
+        grid_indices = np.nonzero(valid)[0]
+
+        for field in POINT_FIELDS:
+            differing_points = points_a[field] != points_b[field]
+            if differing_points.ndim > 2:
+                differing_points = np.any(differing_points, axis=-1)  # e.g. Normal, a point differs if any component does
+            num_differing = np.count_nonzero(differing_points, axis=1)
+            for i in np.nonzero(num_differing)[0]:
+                differing.setdefault(grid_indices[i], []).append("LOD %d %s (%d points)" % (MipLevel, field, num_differing[i]))
+
+    for MipLevel in range(0, min(len(a.pEdgeBase), len(b.pEdgeBase))):
+        edges_a = np.frombuffer(a.pEdgeBase[MipLevel], dtype=np.uint16)
+        edges_b = np.frombuffer(b.pEdgeBase[MipLevel], dtype=np.uint16)
+        num_differing = np.count_nonzero(edges_a != edges_b)
+        if num_differing:
+            diffs.append("Edges: LOD %d (%d values)" % (MipLevel, num_differing))
+
+    for grid_idx in sorted(differing):
+        diffs.append("%s: %s" % (_grid_name(a, grid_idx), ", ".join(differing[grid_idx])))
+
+    if a.Trailing != b.Trailing:
+        diffs.append("Trailing data differs")
+
+    return diffs
+
+
+if __name__ == "__main__":
+    # py terr_validator.py A.TDF [B.TDF ...]  -> validates every TDF
+    # py terr_validator.py --diff A.TDF B.TDF -> compares two TDFs
+    # A TDF that can't be loaded (e.g. truncated) is reported, the batch goes on with the others.
+    def load(path):
+        try:
+            return LR2_Terrain.from_file(path, use_mmap=True, guard_edges=False), []
+        except Exception as e:
+            return None, ["%s can't be loaded: %s" % (path, e)]
+
+    args = sys.argv[1:]
+    results = {}
+    if len(args) == 3 and args[0] == "--diff":
+        ((a, errors_a), (b, errors_b)) = (load(args[1]), load(args[2]))
+        results["%s <> %s" % (args[1], args[2])] = errors_a + errors_b if errors_a or errors_b else diff(a, b)
+    else:
+        for path in args:
+            (terrain, errors) = load(path)
+            results[path] = errors if errors else validate(terrain)
+
+    for name, lines in results.items():
+        print("%s: %s" % (name, "OK" if not lines else "%d issue(s)" % len(lines)))
+        for line in lines:
+            print("  " + line)
+
+    sys.exit(1 if any(results.values()) else 0)